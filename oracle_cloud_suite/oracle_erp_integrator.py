@@ -1,25 +1,183 @@
 import pandas as pd
 import sqlite3
 import os
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 # --- CONFIGURATION ---
 DB_NAME = "synthetic_cfo_erp.db"
+# The build is written here and renamed over DB_NAME only once complete, so an interrupted run leaves the previous database
+BUILD_DB = f"{DB_NAME}.building"
 SOURCE_FILES = {
     "P2P": "Oracle_P2P_Platinum_Mode.xlsx",
     "O2C": "Oracle_O2C_Platinum_Mode.xlsx",
     "CE":  "Oracle_CE_Platinum_Mode.xlsx",
     "GL":  "Oracle_GL_Platinum_Mode.xlsx"
 }
+# Summary/Control tabs are skipped, we only want raw data
+SKIP_SHEETS = {"SUMMARY", "RECONCILIATION_REPORT", "CONTROL_MATRIX"}
+# Sheets are read whole with the calamine engine (dtypes inferred over each full column, as read_excel does)
+# and written to SQLite in blocks of this many rows
+STREAM_BLOCK_ROWS = 10000
+# SQLite column types to_sql gives each inferred column kind (pandas' own mapping; any other kind is TEXT)
+SQL_COLUMN_TYPES = {"floating": "REAL", "integer": "INTEGER", "boolean": "INTEGER", "timedelta64": "INTEGER",
+                    "datetime64": "TIMESTAMP", "datetime": "TIMESTAMP", "date": "DATE", "time": "TIME"}
+# Modules in worker processes at once: the one being written plus one parsed ahead (also capped at the CPU count).
+# Parsed blocks stream back through a pipe; this process stays the only SQLite writer
+PARSE_WORKERS = 2
+# Bulk-load tuning: multi-row INSERTs, capped by SQLite's bound-parameter limit (read from the connection)
+INSERT_CHUNK_ROWS = 1000
+# Write-path tuning for the one-shot bulk build (applied to every integrator connection)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",   # Commits append to the log instead of rewriting a rollback journal
+    "synchronous": "NORMAL", # fsync at checkpoints, not on every commit
+    "temp_store": "MEMORY",
+    "cache_size": -200000,   # ~200 MB page cache (negative = KiB)
+}
+# GL cash accounts reconciled against the bank statement (bound as query parameters)
+GL_CASH_ACCOUNTS = ("11000", "11001", "11002")
+# Indexes on the audit bot's equality filters: (name, table, columns).
+# Single-column keys keep each finding's rows in load order within the index.
+AUDIT_INDEXES = [
+    ("ix_ap_src", "AP_INVOICES_ALL", "SOURCE"),
+    ("ix_ap_checks_status", "AP_CHECKS_ALL", "STATUS_LOOKUP_CODE"),
+    ("ix_ce_lines_match", "CE_STATEMENT_LINES", "GL_MATCH"),
+    ("ix_ce_stmt_date", "CE_STATEMENT_HEADERS", "STATEMENT_DATE"),
+    ("ix_gl_je_src", "GL_JE_LINES", "SOURCE"),
+    ("ix_gl_je_creator", "GL_JE_LINES", "CREATED_BY"),
+]
 
 def log(msg):
     print(f"[SYSTEM] {msg}")
 
+def insert_chunksize(df, max_variables):
+    """Rows per multi-row INSERT, so (rows x columns) stays under SQLite's variable limit."""
+    return max(1, min(INSERT_CHUNK_ROWS, max_variables // max(1, len(df.columns))))
+
+def read_sheet(workbook, sheet, table_name, max_columns):
+    """Parses one sheet of an open calamine pd.ExcelFile; a sheet wider than SQLite allows fails before its cells are converted."""
+    width = workbook.book.get_sheet_by_name(sheet).width
+    if width > max_columns:
+        raise ValueError(f"too many columns on {table_name} ({width}; SQLite allows {max_columns})")
+    return workbook.parse(sheet)
+
+def sql_column_types(df):
+    """SQLite types to_sql infers over the whole sheet, passed to every block so a block cannot re-infer them."""
+    return {col: SQL_COLUMN_TYPES.get(pd.api.types.infer_dtype(df[col], skipna=True), "TEXT") for col in df.columns}
+
+def sheet_blocks(df, block_rows=STREAM_BLOCK_ROWS):
+    """Splits a parsed sheet into DataFrames of at most block_rows rows (an empty sheet still yields one, to create its table)."""
+    for start in range(0, max(len(df), 1), block_rows):
+        yield df.iloc[start:start + block_rows]
+
+_block_pipe = None # Worker: write end of the pipe carrying this module's parsed blocks (set by init_parse_worker)
+
+def init_parse_worker(block_pipe, stderr_path):
+    """Worker: keeps the block pipe and sends stderr to stderr_path, so a native crash reaches the writer as an error."""
+    global _block_pipe
+    _block_pipe = block_pipe
+    os.environ["RUST_BACKTRACE"] = "0" # calamine's allocation abort then leaves a one-line message
+    stderr = os.open(stderr_path, os.O_WRONLY | os.O_APPEND)
+    os.dup2(stderr, 2)
+    os.close(stderr)
+
+def parse_sheet(module, workbook, sheet, max_columns):
+    """Worker: parses one raw data sheet of an open module workbook -> (SQLite column types, DataFrame)."""
+    df = read_sheet(workbook, sheet, sheet, max_columns)
+    # Clean column names (remove spaces, standard format)
+    df.columns = df.columns.str.strip().str.replace(" ", "_", regex=False).str.upper()
+    return sql_column_types(df), df
+
+def parse_module(module, filename, max_columns):
+    """Worker: sends the module's data sheet names, then per sheet its SQLite column types, DataFrame blocks and None.
+
+    A parse error is sent as its message instead; the writer raises it for the sheet it is reading.
+    """
+    try:
+        with pd.ExcelFile(filename, engine='calamine') as workbook:
+            # Only parse the raw data sheets; skipped tabs are never read
+            sheets = [s for s in workbook.sheet_names if s not in SKIP_SHEETS]
+            _block_pipe.send(sheets)
+            for sheet in sheets:
+                sql_types, df = parse_sheet(module, workbook, sheet, max_columns)
+                _block_pipe.send(sql_types)
+                for block in sheet_blocks(df):
+                    _block_pipe.send(block) # Blocks until the writer has taken the previous one off the pipe
+                _block_pipe.send(None)
+    except BrokenPipeError:
+        return # The writer stopped this module
+    except Exception as e:
+        _block_pipe.send(str(e))
+
+def start_module(module, filename, max_columns):
+    """Starts parsing one module in its own worker process -> (pool, read end of its block pipe, stderr log path)."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    stderr_fd, stderr_path = tempfile.mkstemp(prefix=f"{module}_parse_", suffix=".log")
+    os.close(stderr_fd)
+    # A freshly spawned process per module: a crash only takes down its own module, and no other module's pipe is inherited
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_parse_worker, initargs=(sender, stderr_path))
+    pool.submit(parse_module, module, filename, max_columns)
+    sender.close() # The worker now holds the only write end, so its death reads as end of file
+    return pool, receiver, stderr_path
+
+def receive(job, table_name):
+    """Next message from a start_module job; a parse error, or the worker dying, is raised as table_name's error."""
+    _, receiver, stderr_path = job
+    try:
+        message = receiver.recv()
+    except EOFError:
+        with open(stderr_path, errors="replace") as f:
+            # Last line of the crash report, e.g. "memory allocation of 10615259136 bytes failed" (Rust's hints dropped)
+            output = [line.strip() for line in f if line.strip() and not line.startswith("note:")]
+        raise RuntimeError(f"{table_name}: parse worker died ({output[-1] if output else 'no error output'})") from None
+    if isinstance(message, str):
+        raise RuntimeError(message)
+    return message
+
+def received_blocks(job, table_name):
+    """Yields one sheet's DataFrame blocks as the worker sends them, up to its closing None."""
+    while True:
+        df = receive(job, table_name)
+        if df is None:
+            return
+        yield df
+
+def stop_module(job):
+    """Closes a module's block pipe (a worker still sending stops at its next send) and its worker process."""
+    pool, receiver, stderr_path = job
+    receiver.close()
+    pool.shutdown(cancel_futures=True)
+    os.remove(stderr_path)
+
+def tune_connection(conn):
+    """Applies SQLITE_PRAGMAS so the load is CPU-bound rather than fsync-bound."""
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+
+def create_indexes(cursor, indexes):
+    """Builds each index, skipping those whose table/column was not loaded."""
+    for name, table, columns in indexes:
+        try:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+        except sqlite3.OperationalError as e:
+            log(f"   > Skipping index {name} ({str(e)})")
+
 def run_integration():
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-        log(f"Cleaned previous build: {DB_NAME}")
+    if os.path.exists(BUILD_DB):
+        os.remove(BUILD_DB)
+        log(f"Cleaned interrupted build: {BUILD_DB}")
+    # WAL sidecars left by an interrupted build must not be replayed into the new database
+    for sidecar in (f"{BUILD_DB}-wal", f"{BUILD_DB}-shm"):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
 
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(BUILD_DB)
+    tune_connection(conn)
+    # Bound-parameter limit of the linked SQLite build (999 before 3.32, 32766 since)
+    max_variables = conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    max_columns = conn.getlimit(sqlite3.SQLITE_LIMIT_COLUMN) # Columns per table (2000 by default)
     cursor = conn.cursor()
     
     total_tables = 0
@@ -27,41 +185,56 @@ def run_integration():
 
     log("Initializing ERP Schema Injection...")
 
+    modules = []
     for module, filename in SOURCE_FILES.items():
         if not os.path.exists(filename):
             log(f"WARNING: Missing Module {module} ({filename}). Skipping.")
             continue
-            
+        modules.append((module, filename))
+    workers = min(PARSE_WORKERS, os.cpu_count() or 1, len(modules))
+
+    started = {}
+    # Written in SOURCE_FILES order, sheet by sheet, while the next module parses ahead of the writer
+    # (a sheet such as XLA_AE_LINES that several modules ship ends up with the last module's rows)
+    for position, (module, filename) in enumerate(modules):
+        for ahead, ahead_file in modules[position:position + workers]:
+            if ahead not in started:
+                started[ahead] = start_module(ahead, ahead_file, max_columns)
+
         log(f"Processing Module: {module}...")
+        job = started.pop(module)
         try:
-            xls = pd.ExcelFile(filename)
-            for sheet in xls.sheet_names:
-                # Skip Summary/Control tabs, we only want raw data
-                if sheet in ["SUMMARY", "RECONCILIATION_REPORT", "CONTROL_MATRIX"]:
-                    continue
-                
-                df = pd.read_excel(filename, sheet_name=sheet)
-                
-                # Clean column names (remove spaces, standard format)
-                df.columns = [c.strip().replace(" ", "_").upper() for c in df.columns]
-                
-                # Write to SQL
-                df.to_sql(sheet, conn, if_exists='replace', index=False)
-                
-                rows = len(df)
+            for sheet in receive(job, module):
+                sql_types = receive(job, sheet)
+                rows = 0
+                # The first block recreates the table, the rest append to it
+                for block_no, df in enumerate(received_blocks(job, sheet)):
+                    # Write to SQL
+                    df.to_sql(sheet, conn, if_exists='replace' if block_no == 0 else 'append', index=False,
+                              dtype=sql_types, method='multi', chunksize=insert_chunksize(df, max_variables))
+                    rows += len(df)
+
                 total_tables += 1
                 total_rows += rows
                 print(f"   >>> Loaded Table: {sheet} ({rows} rows)")
-                
+
         except Exception as e:
             log(f"CRITICAL FAIL on {module}: {str(e)}")
+        finally:
+            # A failed module stops at the failing sheet, as the serial build did
+            stop_module(job)
+
+    # --- AUDIT INDEXES ---
+    log("Indexing audit predicate columns...")
+    create_indexes(cursor, AUDIT_INDEXES)
 
     # --- CROSS-MODULE INTEGRITY CHECKS ---
     log("Running Cross-Module Forensic Validation...")
     
     # Check 1: Does GL Cash match CE Cash?
     try:
-        cursor.execute("SELECT SUM(ENDING_BALANCE) FROM GL_TRIAL_BALANCE WHERE ACCOUNT IN ('11000','11001','11002')")
+        placeholders = ",".join("?" * len(GL_CASH_ACCOUNTS))
+        cursor.execute(f"SELECT SUM(ENDING_BALANCE) FROM GL_TRIAL_BALANCE WHERE ACCOUNT IN ({placeholders})", GL_CASH_ACCOUNTS)
         gl_cash = cursor.fetchone()[0]
         
         cursor.execute("SELECT SUM(CLOSING_BALANCE) FROM CE_STATEMENT_HEADERS WHERE STATEMENT_DATE = (SELECT MAX(STATEMENT_DATE) FROM CE_STATEMENT_HEADERS)")
@@ -74,7 +247,13 @@ def run_integration():
     except:
         log("   > Skipping Cash Check (Data missing)")
 
+    conn.execute("PRAGMA journal_mode=DELETE") # Fold the WAL back in so the database ships as a single file
     conn.close()
+    # Publish the finished build in one rename (no sidecars of an older DB_NAME may be replayed into it)
+    for sidecar in (f"{DB_NAME}-wal", f"{DB_NAME}-shm"):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+    os.replace(BUILD_DB, DB_NAME)
     
     print("="*60)
     print(f"DEPLOYMENT SUCCESSFUL: {DB_NAME}")
@@ -1,38 +1,57 @@
 import sqlite3
 import pandas as pd
-from fpdf import FPDF
+from fpdf import FPDF, XPos, YPos
 from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from textwrap import wrap
 
 # --- CONFIGURATION ---
 DB_NAME = "synthetic_cfo_erp.db"
 REPORT_FILE = "Forensic_Audit_Report.pdf"
+SHOWN_ROWS = 15 # Rows printed per finding (the rest are only counted)
+# Read-path tuning for the report run (the bot never writes to the database)
+SQLITE_PRAGMAS = {
+    "query_only": 1,
+    "cache_size": -262144,     # ~256 MB page cache (negative = KiB)
+    "mmap_size": 1073741824,   # Map up to 1 GB of the file instead of read() into buffers
+    "temp_store": "MEMORY",    # The findings' ORDER BY / window sorts stay off disk
+}
+# Known column types, applied to the findings instead of re-inferring them from the sample
+COLUMN_DTYPES = {
+    'INVOICE_NUM': 'string', 'VENDOR_ID': 'string', 'CHECK_NUMBER': 'string', 'LINE_ID': 'string',
+    'JE_HEADER_ID': 'string', 'JE_LINE_NUM': 'string',
+    'INVOICE_AMOUNT': 'float64', 'AMOUNT': 'float64', 'ENTERED_DR': 'float64',
+}
 
 class AuditPDF(FPDF):
     def header(self):
         # Branding: lowercase 'synthetic cfo'
-        self.set_font('Arial', 'B', 10)
-        self.cell(0, 10, 'synthetic cfo | AUTOMATED FORENSIC AUDIT BOT', 0, 1, 'R')
+        self.set_font('helvetica', 'B', 10)
+        self.cell(0, 10, 'synthetic cfo | AUTOMATED FORENSIC AUDIT BOT', 0, align='R', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.ln(5)
 
     def footer(self):
         self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+        self.set_font('helvetica', 'I', 8)
+        self.cell(0, 10, f'Page {self.page_no()}', 0, align='C')
 
     def chapter_heading(self, title, description):
-        self.set_font('Arial', 'B', 12)
+        self.set_font('helvetica', 'B', 12)
         self.set_fill_color(32, 55, 100) # Oracle Blue
         self.set_text_color(255, 255, 255)
-        self.cell(0, 8, f'  TEST: {title}', 0, 1, 'L', 1)
+        self.cell(0, 8, f'  TEST: {title}', 0, align='L', fill=True, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         
-        self.set_font('Arial', 'I', 10)
+        self.set_font('helvetica', 'I', 10)
         self.set_text_color(80, 80, 80) # Dark Grey
         self.multi_cell(0, 6, f"Scope: {description}")
         self.ln(2)
 
-    def log_finding_table(self, df, status_msg):
+    def log_finding_table(self, df, status_msg, total=None):
+        # total: size of the full finding when df only holds the printed rows (see read_findings)
+        total = len(df) if total is None else total
         # TRAFFIC LIGHT LOGIC
-        self.set_font('Arial', 'B', 10)
+        self.set_font('helvetica', 'B', 10)
         
         if "FAIL" in status_msg or "CRITICAL" in status_msg:
             self.set_text_color(200, 0, 0) # RED (Confirmed Fraud)
@@ -41,43 +60,111 @@ class AuditPDF(FPDF):
         else:
             self.set_text_color(0, 128, 0) # GREEN (Clean)
             
-        self.cell(0, 6, f"STATUS: {status_msg}", 0, 1, 'L')
+        self.cell(0, 6, f"STATUS: {status_msg}", 0, align='L', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.set_text_color(0, 0, 0) # Reset to black
         self.ln(2)
 
         if not df.empty:
-            # Data Dump (Monospace for table-like look)
+            # Data Dump (monospace cells, one line per printed row)
             self.set_font('Courier', '', 8)
-            self.set_fill_color(245, 245, 245) # Very light grey
-            
-            # Convert DF to string with headers
-            txt_data = df.head(15).to_string(index=False)
-            if len(df) > 15:
-                txt_data += f"\n\n... ({len(df) - 15} more records truncated)"
-            
-            self.multi_cell(0, 4, txt_data, 0, 'L', True)
+            self.finding_table(df.head(SHOWN_ROWS))
+            if total > SHOWN_ROWS:
+                self.cell(0, 6, f"... ({total - SHOWN_ROWS} more records truncated)", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.ln(8)
 
+    def finding_table(self, shown):
+        # Cell text converted frame-wide (missing values print blank), then whole values in float columns
+        # re-converted per column through Int64 so they print without '.0'
+        text = shown.astype(object).where(shown.notna(), '').astype(str)
+        for col in shown.select_dtypes('float').columns:
+            whole = shown[col] % 1 == 0 # False for NaN
+            text.loc[whole, col] = shown.loc[whole, col].astype('Int64').astype(str)
+        rows = [[str(col) for col in shown.columns]] + text.values.tolist()
+        # Column widths sized once from the printed text, in Courier characters (capped so long reasoning wraps)
+        chars = [min(max(len(row[i]) for row in rows), 40) for i in range(len(shown.columns))]
+        char_width = self.get_string_width('0')
+        fit = int(self.epw / char_width) - 2 * len(chars) # Characters a line holds besides the column gaps
+        if sum(chars) > fit:
+            total = sum(chars)
+            chars = [max(width * fit // total, 1) for width in chars]
+        self.set_fill_color(245, 245, 245) # Very light grey
+        # Values that fit print exactly as read (e.g. the trailing whitespace of a hidden duplicate); longer ones wrap
+        cells = [[wrap(value, width) if len(value) > width else [value] for value, width in zip(row, chars)] for row in rows]
+        heading = cells.pop(0)
+        self.finding_row(heading, chars, char_width, heading=True)
+        for row in cells:
+            # A row never splits across pages, and each new page repeats the heading
+            if self.will_page_break(4 * max(len(lines) for lines in row)):
+                self.add_page()
+                self.finding_row(heading, chars, char_width, heading=True)
+            self.finding_row(row, chars, char_width)
+
+    def finding_row(self, row, chars, char_width, heading=False):
+        # One cell per value, one 4 mm line per wrapped line (the heading is bold and ruled below)
+        self.set_font('Courier', 'B' if heading else '', 8)
+        height = max(len(lines) for lines in row)
+        for line_no in range(height):
+            for lines, width in zip(row, chars):
+                self.cell((width + 2) * char_width, 4, lines[line_no] if line_no < len(lines) else '',
+                          border='B' if heading and line_no == height - 1 else 0, fill=True)
+            self.ln(4)
+
+def tune_connection(conn):
+    """Applies SQLITE_PRAGMAS to the bot's single read-only connection."""
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+
+def read_findings(conn, tests, ctes=""):
+    """Runs every test as one UNION ALL round trip tagged by qid -> {name: (first SHOWN_ROWS rows, total count)}.
+
+    tests maps name -> (columns, source, order); each branch is padded with NULLs to a common width.
+    """
+    width = max(len(columns) for columns, _, _ in tests.values())
+    branches = []
+    for qid, (columns, source, order) in enumerate(tests.values()):
+        slots = list(columns) + ["NULL"] * (width - len(columns))
+        branches.append(f"SELECT {qid} AS qid, ROW_NUMBER() OVER (ORDER BY {order}) AS rn, COUNT(*) OVER () AS total, "
+                        + ", ".join(f"{slot} AS c{i}" for i, slot in enumerate(slots)) + f" {source}")
+    rows = conn.execute(f"{ctes} SELECT * FROM ({' UNION ALL '.join(branches)}) "
+                        f"WHERE rn <= {SHOWN_ROWS} ORDER BY qid, rn").fetchall()
+    by_qid = {qid: list(group) for qid, group in groupby(rows, key=itemgetter(0))}
+
+    findings = {}
+    for qid, (name, (columns, _, _)) in enumerate(tests.items()):
+        group = by_qid.get(qid, [])
+        names = [col.split('.')[-1] for col in columns]
+        # Each test gets its own frame, so dtypes are inferred per test rather than across the union
+        df = pd.DataFrame.from_records([row[3:3 + len(names)] for row in group], columns=names, coerce_float=True)
+        for col, dtype in COLUMN_DTYPES.items():
+            if col in names:
+                try:
+                    df[col] = df[col].astype(dtype)
+                except (TypeError, ValueError):
+                    pass # e.g. an amount stored as text: the column keeps its values as read and prints unchanged
+        findings[name] = (df, group[0][2] if group else 0)
+    return findings
+
 def run_audit_bot_pdf():
     print("INITIALIZING FORENSIC AUDIT BOT (PDF ENGINE)...")
     conn = sqlite3.connect(DB_NAME)
+    tune_connection(conn)
     pdf = AuditPDF()
     pdf.add_page()
 
     # --- REPORT HEADER ---
-    pdf.set_font('Arial', 'B', 18)
-    pdf.cell(0, 15, 'FORENSIC AUDIT FINDINGS REPORT', 0, 1, 'C')
-    pdf.set_font('Arial', '', 10)
-    pdf.cell(0, 6, f"Target Database: {DB_NAME}", 0, 1, 'C')
-    pdf.cell(0, 6, f"Execution Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, 1, 'C')
+    pdf.set_font('helvetica', 'B', 18)
+    pdf.cell(0, 15, 'FORENSIC AUDIT FINDINGS REPORT', 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font('helvetica', '', 10)
+    pdf.cell(0, 6, f"Target Database: {DB_NAME}", 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(0, 6, f"Execution Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.ln(10)
 
     # --- STRATEGIC CONTEXT (The "So What?") ---
     pdf.set_fill_color(240, 240, 240)
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, '  HOW TO READ THIS REPORT (STRATEGIC CONTEXT)', 0, 1, 'L', 1)
+    pdf.set_font('helvetica', 'B', 12)
+    pdf.cell(0, 10, '  HOW TO READ THIS REPORT (STRATEGIC CONTEXT)', 0, align='L', fill=True, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     
-    pdf.set_font('Arial', '', 10)
+    pdf.set_font('helvetica', '', 10)
     context_text = (
         "This document validates the 'Synthetic CFO' ERP Simulation. Unlike a standard financial audit where findings are negative, "
         "in this context, findings represent SUCCESSFUL DATA GENERATION.\n\n"
@@ -93,38 +180,79 @@ def run_audit_bot_pdf():
     pdf.multi_cell(0, 6, context_text)
     pdf.ln(10)
 
+    # ==============================================================================
+    # FINDINGS (every test below comes back from one UNION ALL round trip)
+    # ==============================================================================
+
+    # Fused scans: AP_INVOICES_ALL and GL_JE_LINES are each read once into a CTE with a 0/1 flag per test
+    # (C-01, C-08, hygiene / GL-04, GL-03, GL-02); SQLite materializes a CTE the tests reference more than once.
+    # Weekend test runs in SQLite (strftime '%w': 0 = Sunday, 6 = Saturday), which also returns POSTED_DATE
+    # already formatted for the report; the flag expressions still read the raw column.
+    fused_scans = """
+    WITH ap AS (
+        SELECT rowid AS ROW_ID, INVOICE_NUM, VENDOR_ID, INVOICE_AMOUNT, CREATED_BY, LAST_UPDATED_BY as APPROVED_BY,
+            (SOURCE = 'MANUAL' AND INVOICE_AMOUNT > 50000) AS IS_MANUAL,
+            (CREATED_BY = LAST_UPDATED_BY AND APPROVAL_STATUS = 'APPROVED') AS IS_SOD,
+            (INVOICE_NUM LIKE '% ') AS IS_WHITESPACE
+        FROM AP_INVOICES_ALL
+        WHERE (SOURCE = 'MANUAL' AND INVOICE_AMOUNT > 50000)
+           OR (CREATED_BY = LAST_UPDATED_BY AND APPROVAL_STATUS = 'APPROVED')
+           OR INVOICE_NUM LIKE '% '
+    ),
+    gl AS (
+        SELECT rowid AS ROW_ID, JE_HEADER_ID, JE_LINE_NUM, ENTERED_DR, CREATED_BY, SOURCE, PERIOD_NAME,
+            strftime('%Y-%m-%d', POSTED_DATE) AS POSTED_DATE,
+            (CREATED_BY = 'CFO_OVERRIDE') AS IS_OVERRIDE,
+            (ENTERED_DR > 1000000 AND CAST(ENTERED_DR AS INTEGER) % 10000 = 0 AND SOURCE = 'Manual') AS IS_ROUND,
+            (SOURCE = 'Manual' AND ENTERED_DR > 500000 AND CAST(strftime('%w', POSTED_DATE) AS INTEGER) IN (0, 6)) AS IS_WEEKEND
+        FROM GL_JE_LINES
+        WHERE CREATED_BY = 'CFO_OVERRIDE'
+           OR (ENTERED_DR > 1000000 AND CAST(ENTERED_DR AS INTEGER) % 10000 = 0 AND SOURCE = 'Manual')
+           OR (SOURCE = 'Manual' AND ENTERED_DR > 500000 AND CAST(strftime('%w', POSTED_DATE) AS INTEGER) IN (0, 6))
+    )
+    """
+    # name -> (columns, source, load-order key)
+    findings = read_findings(conn, {
+        'manual': (['INVOICE_NUM', 'VENDOR_ID', 'INVOICE_AMOUNT', 'CREATED_BY'], "FROM ap WHERE IS_MANUAL = 1", "ROW_ID"),
+        'sod': (['INVOICE_NUM', 'INVOICE_AMOUNT', 'CREATED_BY', 'APPROVED_BY'], "FROM ap WHERE IS_SOD = 1", "ROW_ID"),
+        'white': (['INVOICE_NUM', 'VENDOR_ID', 'INVOICE_AMOUNT'], "FROM ap WHERE IS_WHITESPACE = 1", "ROW_ID"),
+        'void': (['CHECK_NUMBER', 'AMOUNT', 'CHECK_DATE', 'VENDOR_ID'],
+                 "FROM AP_CHECKS_ALL WHERE STATUS_LOOKUP_CODE = 'VOIDED'", "rowid"),
+        'kiting': (['LINE_ID', 'TRX_CODE', 'AMOUNT', 'DESC'],
+                   "FROM CE_STATEMENT_LINES WHERE GL_MATCH = 'NO_MATCH' AND DESC LIKE '%KITE%'", "rowid"),
+        'override': (['JE_HEADER_ID', 'JE_LINE_NUM', 'ENTERED_DR', 'CREATED_BY'], "FROM gl WHERE IS_OVERRIDE = 1", "ROW_ID"),
+        'round': (['JE_HEADER_ID', 'ENTERED_DR', 'SOURCE', 'PERIOD_NAME'], "FROM gl WHERE IS_ROUND = 1", "ROW_ID"),
+        'weekend': (['JE_HEADER_ID', 'POSTED_DATE', 'ENTERED_DR'], "FROM gl WHERE IS_WEEKEND = 1", "ROW_ID"),
+    }, ctes=fused_scans)
+
     # ==============================================================================
     # MODULE: P2P (PROCURE-TO-PAY)
     # ==============================================================================
-    
+
     # 1. Manual Invoices (C-01)
-    query_manual = "SELECT INVOICE_NUM, VENDOR_ID, INVOICE_AMOUNT, CREATED_BY FROM AP_INVOICES_ALL WHERE SOURCE = 'MANUAL' AND INVOICE_AMOUNT > 50000"
-    df_manual = pd.read_sql(query_manual, conn)
+    df_manual, n_manual = findings['manual']
     pdf.chapter_heading("HIGH VALUE MANUAL INVOICES (C-01)", "Flagging manual entries > $50k bypassing PO.")
     # Logic: Finding manual invoices is a WARNING (High Risk), not necessarily a FAIL unless unapproved
-    status = "CLEAN" if df_manual.empty else f"WARN ({len(df_manual)} Manual Entries)"
-    pdf.log_finding_table(df_manual, status)
+    status = "CLEAN" if n_manual == 0 else f"WARN ({n_manual} Manual Entries)"
+    pdf.log_finding_table(df_manual, status, n_manual)
 
     # 2. SOD Conflicts (C-08)
-    query_sod = "SELECT INVOICE_NUM, INVOICE_AMOUNT, CREATED_BY, LAST_UPDATED_BY as APPROVED_BY FROM AP_INVOICES_ALL WHERE CREATED_BY = LAST_UPDATED_BY AND APPROVAL_STATUS = 'APPROVED'"
-    df_sod = pd.read_sql(query_sod, conn)
+    df_sod, n_sod = findings['sod']
     pdf.chapter_heading("SEGREGATION OF DUTIES (C-08)", "Invoices where Creator == Approver.")
-    status = "CLEAN" if df_sod.empty else f"FAIL ({len(df_sod)} Conflicts)"
-    pdf.log_finding_table(df_sod, status)
+    status = "CLEAN" if n_sod == 0 else f"FAIL ({n_sod} Conflicts)"
+    pdf.log_finding_table(df_sod, status, n_sod)
 
     # 3. Whitespace Duplicates (Data Hygiene)
-    query_white = "SELECT INVOICE_NUM, VENDOR_ID, INVOICE_AMOUNT FROM AP_INVOICES_ALL WHERE INVOICE_NUM LIKE '% '"
-    df_white = pd.read_sql(query_white, conn)
+    df_white, n_white = findings['white']
     pdf.chapter_heading("DATA SANITIZATION / HIDDEN DUPLICATES", "Invoices with trailing whitespace used to bypass unique constraints.")
-    status = "CLEAN" if df_white.empty else f"FAIL ({len(df_white)} Anomalies)"
-    pdf.log_finding_table(df_white, status)
+    status = "CLEAN" if n_white == 0 else f"FAIL ({n_white} Anomalies)"
+    pdf.log_finding_table(df_white, status, n_white)
 
     # 4. Voided Checks (C-06)
-    query_void = "SELECT CHECK_NUMBER, AMOUNT, CHECK_DATE, VENDOR_ID FROM AP_CHECKS_ALL WHERE STATUS_LOOKUP_CODE = 'VOIDED'"
-    df_void = pd.read_sql(query_void, conn)
+    df_void, n_void = findings['void']
     pdf.chapter_heading("VOIDED PAYMENTS (C-06)", "Listing voided checks for review.")
-    status = "CLEAN" if df_void.empty else f"WARN ({len(df_void)} Voids)"
-    pdf.log_finding_table(df_void, status)
+    status = "CLEAN" if n_void == 0 else f"WARN ({n_void} Voids)"
+    pdf.log_finding_table(df_void, status, n_void)
 
     pdf.add_page() # Page Break
 
@@ -133,43 +261,35 @@ def run_audit_bot_pdf():
     # ==============================================================================
 
     # 5. Kiting (CASH-01)
-    query_kiting = "SELECT LINE_ID, TRX_CODE, AMOUNT, DESC FROM CE_STATEMENT_LINES WHERE GL_MATCH = 'NO_MATCH' AND DESC LIKE '%KITE%'"
-    df_kiting = pd.read_sql(query_kiting, conn)
+    df_kiting, n_kiting = findings['kiting']
     pdf.chapter_heading("CHECK KITING / UNRECORDED FUNDS (CASH-01)", "Large wire transfers in Bank missing from GL.")
-    status = "CLEAN" if df_kiting.empty else f"CRITICAL FAIL ({len(df_kiting)} Kiting Events)"
-    pdf.log_finding_table(df_kiting, status)
+    status = "CLEAN" if n_kiting == 0 else f"CRITICAL FAIL ({n_kiting} Kiting Events)"
+    pdf.log_finding_table(df_kiting, status, n_kiting)
 
     # ==============================================================================
     # MODULE: GL (GENERAL LEDGER)
     # ==============================================================================
 
     # 6. Management Override (GL-04)
-    query_override = "SELECT JE_HEADER_ID, JE_LINE_NUM, ENTERED_DR, CREATED_BY FROM GL_JE_LINES WHERE CREATED_BY = 'CFO_OVERRIDE'"
-    df_override = pd.read_sql(query_override, conn)
+    df_override, n_override = findings['override']
     pdf.chapter_heading("MANAGEMENT OVERRIDE (GL-04)", "Entries by restricted user 'CFO_OVERRIDE'.")
-    status = "CLEAN" if df_override.empty else f"CRITICAL FAIL ({len(df_override)} Overrides)"
-    pdf.log_finding_table(df_override, status)
+    status = "CLEAN" if n_override == 0 else f"CRITICAL FAIL ({n_override} Overrides)"
+    pdf.log_finding_table(df_override, status, n_override)
 
     # 7. Benford's Law (GL-03)
-    query_round = "SELECT JE_HEADER_ID, ENTERED_DR, SOURCE, PERIOD_NAME FROM GL_JE_LINES WHERE ENTERED_DR > 1000000 AND CAST(ENTERED_DR AS INTEGER) % 10000 = 0 AND SOURCE = 'Manual'"
-    df_round = pd.read_sql(query_round, conn)
+    df_round, n_round = findings['round']
     pdf.chapter_heading("BENFORD'S LAW VIOLATIONS (GL-03)", "Large, perfectly round manual adjustments (> $1M).")
-    status = "CLEAN" if df_round.empty else f"FAIL ({len(df_round)} Suspicious Entries)"
-    pdf.log_finding_table(df_round, status)
+    status = "CLEAN" if n_round == 0 else f"FAIL ({n_round} Suspicious Entries)"
+    pdf.log_finding_table(df_round, status, n_round)
 
     # 8. Weekend Posting (GL-02)
-    query_dates = "SELECT JE_HEADER_ID, POSTED_DATE, ENTERED_DR FROM GL_JE_LINES WHERE SOURCE = 'Manual'"
-    df_dates = pd.read_sql(query_dates, conn)
-    df_dates['POSTED_DATE'] = pd.to_datetime(df_dates['POSTED_DATE'])
-    df_weekend = df_dates[(df_dates['POSTED_DATE'].dt.weekday >= 5) & (df_dates['ENTERED_DR'] > 500000)]
-    df_weekend['POSTED_DATE'] = df_weekend['POSTED_DATE'].dt.strftime('%Y-%m-%d')
-    
+    df_weekend, n_weekend = findings['weekend']
     pdf.chapter_heading("SUSPICIOUS WEEKEND POSTINGS (GL-02)", "Manual JEs > $500k posted on Sat/Sun.")
-    status = "CLEAN" if df_weekend.empty else f"WARN ({len(df_weekend)} Weekend Postings)"
-    pdf.log_finding_table(df_weekend, status)
+    status = "CLEAN" if n_weekend == 0 else f"WARN ({n_weekend} Weekend Postings)"
+    pdf.log_finding_table(df_weekend, status, n_weekend)
 
     # --- SAVE ---
-    pdf.output(REPORT_FILE, 'F')
+    pdf.output(REPORT_FILE)
     conn.close()
     print(f"SUCCESS: Platinum Audit PDF Generated: '{REPORT_FILE}'")
 
@@ -1,37 +1,57 @@
 import sqlite3
 import pandas as pd
-from fpdf import FPDF
+from fpdf import FPDF, XPos, YPos
 from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from textwrap import wrap
 
 # --- CONFIGURATION ---
 DB_NAME = "synthetic_cfo_sap_ecc.db"
 REPORT_FILE = "SAP_ECC_Forensic_Audit_Report_Platinum.pdf"
+CURRENCY_COLS = ['NETWR', 'WRBTR', 'DMBTR', 'UMSATZ']
+SHOWN_ROWS = 15 # Rows printed per finding (the rest are only counted)
+# Read-path tuning for the report run (the bot never writes to the database)
+SQLITE_PRAGMAS = {
+    "query_only": 1,
+    "cache_size": -262144,     # ~256 MB page cache (negative = KiB)
+    "mmap_size": 1073741824,   # Map up to 1 GB of the file instead of read() into buffers
+    "temp_store": "MEMORY",    # The findings' ORDER BY / window sorts stay off disk
+}
+# Known column types, applied to the findings instead of re-inferring them from the sample
+COLUMN_DTYPES = {
+    'BELNR': 'string', 'EBELN': 'string', 'XBLNR': 'string', 'VBELN': 'string',
+    'KUKEY': 'string', 'ESNUM': 'string', 'HKONT': 'string',
+    'NETWR': 'float64', 'UMSATZ': 'float64', 'WRBTR': 'float64',
+}
 
 class AuditPDF(FPDF):
     def header(self):
-        self.set_font('Arial', 'B', 10)
-        self.cell(0, 10, 'synthetic cfo | AUTOMATED FORENSIC AUDIT BOT', 0, 1, 'R')
+        self.set_font('helvetica', 'B', 10)
+        self.cell(0, 10, 'synthetic cfo | AUTOMATED FORENSIC AUDIT BOT', 0, align='R', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.ln(5)
 
     def footer(self):
         self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+        self.set_font('helvetica', 'I', 8)
+        self.cell(0, 10, f'Page {self.page_no()}', 0, align='C')
 
     def chapter_heading(self, title, description):
-        self.set_font('Arial', 'B', 12)
+        self.set_font('helvetica', 'B', 12)
         self.set_fill_color(32, 55, 100) # Professional Blue
         self.set_text_color(255, 255, 255)
-        self.cell(0, 8, f"  TEST: {title}", 0, 1, 'L', 1)
+        self.cell(0, 8, f"  TEST: {title}", 0, align='L', fill=True, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         
-        self.set_font('Arial', 'I', 10)
+        self.set_font('helvetica', 'I', 10)
         self.set_text_color(80, 80, 80)
         self.multi_cell(0, 6, f"Scope: {description}")
         self.ln(2)
 
-    def log_finding_table(self, df, status_msg):
+    def log_finding_table(self, df, status_msg, total=None):
+        # total: size of the full finding when df only holds the printed rows (see read_findings)
+        total = len(df) if total is None else total
         # TRAFFIC LIGHT LOGIC
-        self.set_font('Arial', 'B', 10)
+        self.set_font('helvetica', 'B', 10)
         
         if "FAIL" in status_msg or "CRITICAL" in status_msg:
             self.set_text_color(200, 0, 0) # RED
@@ -40,48 +60,120 @@ class AuditPDF(FPDF):
         else:
             self.set_text_color(0, 128, 0) # GREEN
             
-        self.cell(0, 6, f"STATUS: {status_msg}", 0, 1, 'L')
+        self.cell(0, 6, f"STATUS: {status_msg}", 0, align='L', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.set_text_color(0, 0, 0) # Reset
         self.ln(2)
 
         if not df.empty:
             self.set_font('Courier', '', 8)
-            self.set_fill_color(245, 245, 245)
             
-            # Format currency columns for readability if present
-            for col in ['NETWR', 'WRBTR', 'DMBTR', 'UMSATZ']:
-                if col in df.columns:
+            # Format currency columns for readability if present (only the printed rows)
+            shown = df.head(SHOWN_ROWS).copy()
+            for col in CURRENCY_COLS:
+                if col in shown.columns:
                     try:
-                        df[col] = df[col].apply(lambda x: f"{float(x):,.2f}")
-                    except: pass
+                        shown[col] = pd.to_numeric(shown[col]).map('{:,.2f}'.format, na_action='ignore')
+                    except (TypeError, ValueError): pass
 
-            txt_data = df.head(15).to_string(index=False)
-            if len(df) > 15:
-                txt_data += f"\n\n... ({len(df) - 15} more records truncated)"
-            
-            self.multi_cell(0, 4, txt_data, 0, 'L', True)
+            # Data Dump (monospace cells, one line per printed row)
+            self.finding_table(shown)
+            if total > SHOWN_ROWS:
+                self.cell(0, 6, f"... ({total - SHOWN_ROWS} more records truncated)", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.ln(8)
 
+    def finding_table(self, shown):
+        # Cell text converted frame-wide (missing values print blank), then whole values in float columns
+        # re-converted per column through Int64 so they print without '.0'
+        text = shown.astype(object).where(shown.notna(), '').astype(str)
+        for col in shown.select_dtypes('float').columns:
+            whole = shown[col] % 1 == 0 # False for NaN
+            text.loc[whole, col] = shown.loc[whole, col].astype('Int64').astype(str)
+        rows = [[str(col) for col in shown.columns]] + text.values.tolist()
+        # Column widths sized once from the printed text, in Courier characters (capped so long reasoning wraps)
+        chars = [min(max(len(row[i]) for row in rows), 40) for i in range(len(shown.columns))]
+        char_width = self.get_string_width('0')
+        fit = int(self.epw / char_width) - 2 * len(chars) # Characters a line holds besides the column gaps
+        if sum(chars) > fit:
+            total = sum(chars)
+            chars = [max(width * fit // total, 1) for width in chars]
+        self.set_fill_color(245, 245, 245) # Very light grey
+        # Values that fit print exactly as read (e.g. the trailing whitespace of a hidden duplicate); longer ones wrap
+        cells = [[wrap(value, width) if len(value) > width else [value] for value, width in zip(row, chars)] for row in rows]
+        heading = cells.pop(0)
+        self.finding_row(heading, chars, char_width, heading=True)
+        for row in cells:
+            # A row never splits across pages, and each new page repeats the heading
+            if self.will_page_break(4 * max(len(lines) for lines in row)):
+                self.add_page()
+                self.finding_row(heading, chars, char_width, heading=True)
+            self.finding_row(row, chars, char_width)
+
+    def finding_row(self, row, chars, char_width, heading=False):
+        # One cell per value, one 4 mm line per wrapped line (the heading is bold and ruled below)
+        self.set_font('Courier', 'B' if heading else '', 8)
+        height = max(len(lines) for lines in row)
+        for line_no in range(height):
+            for lines, width in zip(row, chars):
+                self.cell((width + 2) * char_width, 4, lines[line_no] if line_no < len(lines) else '',
+                          border='B' if heading and line_no == height - 1 else 0, fill=True)
+            self.ln(4)
+
+def tune_connection(conn):
+    """Applies SQLITE_PRAGMAS to the bot's single read-only connection."""
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+
+def read_findings(conn, tests, ctes=""):
+    """Runs every test as one UNION ALL round trip tagged by qid -> {name: (first SHOWN_ROWS rows, total count)}.
+
+    tests maps name -> (columns, source, order); each branch is padded with NULLs to a common width.
+    """
+    width = max(len(columns) for columns, _, _ in tests.values())
+    branches = []
+    for qid, (columns, source, order) in enumerate(tests.values()):
+        slots = list(columns) + ["NULL"] * (width - len(columns))
+        branches.append(f"SELECT {qid} AS qid, ROW_NUMBER() OVER (ORDER BY {order}) AS rn, COUNT(*) OVER () AS total, "
+                        + ", ".join(f"{slot} AS c{i}" for i, slot in enumerate(slots)) + f" {source}")
+    rows = conn.execute(f"{ctes} SELECT * FROM ({' UNION ALL '.join(branches)}) "
+                        f"WHERE rn <= {SHOWN_ROWS} ORDER BY qid, rn").fetchall()
+    by_qid = {qid: list(group) for qid, group in groupby(rows, key=itemgetter(0))}
+
+    findings = {}
+    for qid, (name, (columns, _, _)) in enumerate(tests.items()):
+        group = by_qid.get(qid, [])
+        names = [col.split('.')[-1] for col in columns]
+        # Each test gets its own frame, so dtypes are inferred per test rather than across the union
+        df = pd.DataFrame.from_records([row[3:3 + len(names)] for row in group], columns=names, coerce_float=True)
+        for col, dtype in COLUMN_DTYPES.items():
+            if col in names:
+                try:
+                    df[col] = df[col].astype(dtype)
+                except (TypeError, ValueError):
+                    pass # e.g. an amount stored as text: the column keeps its values as read and prints unchanged
+        findings[name] = (df, group[0][2] if group else 0)
+    return findings
+
 def run_audit_bot_pdf():
     print("INITIALIZING SAP ECC FORENSIC AUDIT BOT (PDF ENGINE)...")
     conn = sqlite3.connect(DB_NAME)
+    tune_connection(conn)
     pdf = AuditPDF()
     pdf.add_page()
 
     # --- REPORT HEADER ---
-    pdf.set_font('Arial', 'B', 18)
-    pdf.cell(0, 15, 'FORENSIC AUDIT FINDINGS REPORT', 0, 1, 'C')
-    pdf.set_font('Arial', '', 10)
-    pdf.cell(0, 6, f"Target Database: {DB_NAME}", 0, 1, 'C')
-    pdf.cell(0, 6, f"Execution Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, 1, 'C')
+    pdf.set_font('helvetica', 'B', 18)
+    pdf.cell(0, 15, 'FORENSIC AUDIT FINDINGS REPORT', 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font('helvetica', '', 10)
+    pdf.cell(0, 6, f"Target Database: {DB_NAME}", 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(0, 6, f"Execution Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.ln(10)
 
     # --- STRATEGIC CONTEXT (THE "HOW TO READ THIS" SECTION) ---
     pdf.set_fill_color(240, 240, 240)
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, '  HOW TO READ THIS REPORT (STRATEGIC CONTEXT)', 0, 1, 'L', 1)
+    pdf.set_font('helvetica', 'B', 12)
+    pdf.cell(0, 10, '  HOW TO READ THIS REPORT (STRATEGIC CONTEXT)', 0, align='L', fill=True, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     
-    pdf.set_font('Arial', '', 10)
+    pdf.set_font('helvetica', '', 10)
     context_text = (
         "This document validates the 'Synthetic CFO' SAP ECC Simulation. Unlike a standard financial audit where findings are negative, "
         "in this context, findings represent SUCCESSFUL DATA GENERATION.\n\n"
@@ -97,30 +189,54 @@ def run_audit_bot_pdf():
     pdf.multi_cell(0, 6, context_text)
     pdf.ln(10)
 
+    # ==============================================================================
+    # FINDINGS (every test below comes back from one UNION ALL round trip)
+    # ==============================================================================
+
+    # SME_REASONING tests seek the indexed SME_TAG the integrator classified at ingest.
+    # A row matching two tests of one table carries both tags (e.g. 'KITING+LAPPING').
+    # name -> (columns, source, load-order key)
+    findings = read_findings(conn, {
+        'sod': (['BELNR', 'USNAM', 'TCODE', 'SME_REASONING'], "FROM P2P_BKPF WHERE SME_TAG = 'SOD'", "rowid"),
+        'split': (['EBELN', 'ERNAM', 'NETWR', 'SME_REASONING'], "FROM P2P_EKKO WHERE SME_TAG = 'SPLIT'", "rowid"),
+        'dup': (['BELNR', 'XBLNR', 'BKTXT'], "FROM P2P_BKPF WHERE XBLNR LIKE '% ' OR BKTXT LIKE '%Duplicate%'", "rowid"),
+        'stuffing': (['VBELN', 'NETWR', 'FKDAT', 'SME_REASONING'],
+                     "FROM O2C_VBRK WHERE SME_TAG IN ('STUFFING', 'STUFFING+PHANTOM')", "rowid"),
+        'phantom': (['VBELN', 'NETWR', 'KUNRG', 'SME_REASONING'],
+                    "FROM O2C_VBRK WHERE SME_TAG IN ('PHANTOM', 'STUFFING+PHANTOM')", "rowid"),
+        'kiting': (['KUKEY', 'ESNUM', 'UMSATZ', 'VALUT', 'SME_REASONING'],
+                   "FROM CE_FEBEP WHERE SME_TAG IN ('KITING', 'KITING+LAPPING')", "rowid"),
+        'lapping': (['KUKEY', 'ESNUM', 'UMSATZ', 'PARTN', 'SME_REASONING'],
+                    "FROM CE_FEBEP WHERE SME_TAG IN ('LAPPING', 'KITING+LAPPING')", "rowid"),
+        # FIX: Using explicit aliases to avoid 'Ambiguous column' error
+        'cookie': (['R2R_BSEG.BELNR', 'R2R_BSEG.WRBTR', 'R2R_BSEG.SME_REASONING'],
+                   "FROM R2R_BSEG LEFT JOIN R2R_BKPF ON R2R_BSEG.BELNR = R2R_BKPF.BELNR "
+                   "WHERE R2R_BSEG.SME_TAG IN ('COOKIE_JAR', 'COOKIE_JAR+TOP_SIDE')", "R2R_BSEG.rowid"),
+        'topside': (['BELNR', 'HKONT', 'SME_REASONING'],
+                    "FROM R2R_BSEG WHERE SME_TAG IN ('TOP_SIDE', 'COOKIE_JAR+TOP_SIDE')", "rowid"),
+    })
+
     # ==============================================================================
     # MODULE: P2P (PROCURE-TO-PAY)
     # ==============================================================================
     
     # 1. SOD Conflicts
-    query_sod = "SELECT BELNR, USNAM, TCODE, SME_REASONING FROM P2P_BKPF WHERE SME_REASONING LIKE '%SOD%' OR SME_REASONING LIKE '%Self-Approval%'"
-    df_sod = pd.read_sql(query_sod, conn)
-    status = "CLEAN" if df_sod.empty else f"FAIL ({len(df_sod)} Conflicts)"
+    df_sod, n_sod = findings['sod']
+    status = "CLEAN" if n_sod == 0 else f"FAIL ({n_sod} Conflicts)"
     pdf.chapter_heading("SEGREGATION OF DUTIES (P2P-02)", "Transactions where Creator == Approver.")
-    pdf.log_finding_table(df_sod, status)
+    pdf.log_finding_table(df_sod, status, n_sod)
 
     # 2. Split POs
-    query_split = "SELECT EBELN, ERNAM, NETWR, SME_REASONING FROM P2P_EKKO WHERE SME_REASONING LIKE '%Split%' OR SME_REASONING LIKE '%Limit Evasion%'"
-    df_split = pd.read_sql(query_split, conn)
-    status = "CLEAN" if df_split.empty else f"FAIL ({len(df_split)} Split POs)"
+    df_split, n_split = findings['split']
+    status = "CLEAN" if n_split == 0 else f"FAIL ({n_split} Split POs)"
     pdf.chapter_heading("SPLIT PURCHASE ORDERS (P2P-03)", "Structuring orders to bypass approval limits.")
-    pdf.log_finding_table(df_split, status)
+    pdf.log_finding_table(df_split, status, n_split)
 
     # 3. Duplicate Invoices
-    query_dup = "SELECT BELNR, XBLNR, BKTXT FROM P2P_BKPF WHERE XBLNR LIKE '% ' OR BKTXT LIKE '%Duplicate%'"
-    df_dup = pd.read_sql(query_dup, conn)
-    status = "CLEAN" if df_dup.empty else f"FAIL ({len(df_dup)} Duplicates)"
+    df_dup, n_dup = findings['dup']
+    status = "CLEAN" if n_dup == 0 else f"FAIL ({n_dup} Duplicates)"
     pdf.chapter_heading("DUPLICATE INVOICES (P2P-01)", "Invoices with trailing whitespace used to bypass uniqueness checks.")
-    pdf.log_finding_table(df_dup, status)
+    pdf.log_finding_table(df_dup, status, n_dup)
 
     pdf.add_page() 
 
@@ -129,36 +245,32 @@ def run_audit_bot_pdf():
     # ==============================================================================
 
     # 4. Channel Stuffing
-    query_stuffing = "SELECT VBELN, NETWR, FKDAT, SME_REASONING FROM O2C_VBRK WHERE SME_REASONING LIKE '%Stuffing%' OR SME_REASONING LIKE '%Force%' OR SME_REASONING LIKE '%Premature%'"
-    df_stuffing = pd.read_sql(query_stuffing, conn)
-    status = "CLEAN" if df_stuffing.empty else f"FAIL ({len(df_stuffing)} Stuffing Events)"
+    df_stuffing, n_stuffing = findings['stuffing']
+    status = "CLEAN" if n_stuffing == 0 else f"FAIL ({n_stuffing} Stuffing Events)"
     pdf.chapter_heading("REVENUE CUT-OFF / CHANNEL STUFFING (O2C-02)", "High-value sales forced through at month-end.")
-    pdf.log_finding_table(df_stuffing, status)
+    pdf.log_finding_table(df_stuffing, status, n_stuffing)
 
     # 5. Phantom Billing
-    query_phantom = "SELECT VBELN, NETWR, KUNRG, SME_REASONING FROM O2C_VBRK WHERE SME_REASONING LIKE '%Phantom%' OR SME_REASONING LIKE '%No Goods Issue%'"
-    df_phantom = pd.read_sql(query_phantom, conn)
-    status = "CLEAN" if df_phantom.empty else f"CRITICAL FAIL ({len(df_phantom)} Phantom Bills)"
+    df_phantom, n_phantom = findings['phantom']
+    status = "CLEAN" if n_phantom == 0 else f"CRITICAL FAIL ({n_phantom} Phantom Bills)"
     pdf.chapter_heading("PHANTOM BILLING (O2C-03)", "Revenue recognition without proof of delivery (Goods Issue).")
-    pdf.log_finding_table(df_phantom, status)
+    pdf.log_finding_table(df_phantom, status, n_phantom)
 
     # ==============================================================================
     # MODULE: CE (CASH MANAGEMENT)
     # ==============================================================================
 
     # 6. Kiting
-    query_kiting = "SELECT KUKEY, ESNUM, UMSATZ, VALUT, SME_REASONING FROM CE_FEBEP WHERE SME_REASONING LIKE '%Kiting%'"
-    df_kiting = pd.read_sql(query_kiting, conn)
-    status = "CLEAN" if df_kiting.empty else f"CRITICAL FAIL ({len(df_kiting)} Kiting Events)"
+    df_kiting, n_kiting = findings['kiting']
+    status = "CLEAN" if n_kiting == 0 else f"CRITICAL FAIL ({n_kiting} Kiting Events)"
     pdf.chapter_heading("CHECK KITING (CE-01)", "Large transfers with value date mismatches (Float Fraud).")
-    pdf.log_finding_table(df_kiting, status)
+    pdf.log_finding_table(df_kiting, status, n_kiting)
 
     # 7. Lapping
-    query_lapping = "SELECT KUKEY, ESNUM, UMSATZ, PARTN, SME_REASONING FROM CE_FEBEP WHERE SME_REASONING LIKE '%Lapping%' OR SME_REASONING LIKE '%Mismatch%'"
-    df_lapping = pd.read_sql(query_lapping, conn)
-    status = "CLEAN" if df_lapping.empty else f"FAIL ({len(df_lapping)} Lapping Events)"
+    df_lapping, n_lapping = findings['lapping']
+    status = "CLEAN" if n_lapping == 0 else f"FAIL ({n_lapping} Lapping Events)"
     pdf.chapter_heading("LAPPING / TEEMING (CE-03)", "Receivables applied to the wrong customer account.")
-    pdf.log_finding_table(df_lapping, status)
+    pdf.log_finding_table(df_lapping, status, n_lapping)
 
     pdf.add_page()
 
@@ -167,31 +279,19 @@ def run_audit_bot_pdf():
     # ==============================================================================
 
     # 8. Cookie Jar Reserves
-    # FIX: Using explicit aliases to avoid 'Ambiguous column' error
-    query_cookie = """
-    SELECT 
-        R2R_BSEG.BELNR, 
-        R2R_BSEG.WRBTR, 
-        R2R_BSEG.SME_REASONING 
-    FROM R2R_BSEG 
-    LEFT JOIN R2R_BKPF ON R2R_BSEG.BELNR = R2R_BKPF.BELNR 
-    WHERE R2R_BSEG.SME_REASONING LIKE '%Cookie Jar%' 
-       OR R2R_BSEG.SME_REASONING LIKE '%Reserve Release%'
-    """
-    df_cookie = pd.read_sql(query_cookie, conn)
-    status = "CLEAN" if df_cookie.empty else f"CRITICAL FAIL ({len(df_cookie)} Reserve Releases)"
+    df_cookie, n_cookie = findings['cookie']
+    status = "CLEAN" if n_cookie == 0 else f"CRITICAL FAIL ({n_cookie} Reserve Releases)"
     pdf.chapter_heading("COOKIE JAR RESERVES (R2R-02)", "Earnings management via manual reserve releases.")
-    pdf.log_finding_table(df_cookie, status)
+    pdf.log_finding_table(df_cookie, status, n_cookie)
 
     # 9. Top-Side Adjustments
-    query_topside = "SELECT BELNR, HKONT, SME_REASONING FROM R2R_BSEG WHERE SME_REASONING LIKE '%Top-Side%' OR SME_REASONING LIKE '%Reconciliation Account%'"
-    df_topside = pd.read_sql(query_topside, conn)
-    status = "CLEAN" if df_topside.empty else f"FAIL ({len(df_topside)} Top-Side Adjs)"
+    df_topside, n_topside = findings['topside']
+    status = "CLEAN" if n_topside == 0 else f"FAIL ({n_topside} Top-Side Adjs)"
     pdf.chapter_heading("TOP-SIDE ADJUSTMENTS (R2R-04)", "Direct posting to Control Accounts bypassing sub-ledgers.")
-    pdf.log_finding_table(df_topside, status)
+    pdf.log_finding_table(df_topside, status, n_topside)
 
     # --- SAVE ---
-    pdf.output(REPORT_FILE, 'F')
+    pdf.output(REPORT_FILE)
     conn.close()
     print(f"SUCCESS: Platinum Audit PDF Generated: '{REPORT_FILE}'")
 
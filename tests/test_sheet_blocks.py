@@ -0,0 +1,107 @@
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+openpyxl = pytest.importorskip("openpyxl")
+pytest.importorskip("python_calamine")
+
+ROOT = Path(__file__).resolve().parents[1]
+INTEGRATORS = [
+    ROOT / "oracle_cloud_suite" / "oracle_erp_integrator.py",
+    ROOT / "sap_ecc_suite" / "sap_erp_integrator.py",
+]
+
+# Integer document numbers with text only after the first blocks, a blank ID, and an amount column
+# closed by an 'end of sample' row
+ROWS = [
+    ["BELNR", "WRBTR", "BUDAT"],
+    [100005062, 10, "2024-01-01"],
+    [100005063, 60000, "2024-01-02"],
+    [None, 70000.5, None],
+    [400, None, "2024-01-04"],
+    ["DOC-5", 80000, "2024-01-05"],
+    [6, "end of sample", "2024-01-06"],
+]
+
+
+def load_integrator(path):
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_table(conn, name, frames, dtype=None):
+    for block_no, df in enumerate(frames):
+        df.to_sql(name, conn, if_exists='replace' if block_no == 0 else 'append', index=False, dtype=dtype)
+    declared = [column[2] for column in conn.execute(f"PRAGMA table_info({name})")]
+    return declared, conn.execute(f"SELECT *, typeof(BELNR), typeof(WRBTR) FROM {name} ORDER BY rowid").fetchall()
+
+
+def streamed_blocks(integrator, workbook_path, block_rows):
+    with pd.ExcelFile(workbook_path, engine='calamine') as workbook:
+        df = workbook.parse("BSEG")
+    return integrator.sql_column_types(df), list(integrator.sheet_blocks(df, block_rows=block_rows))
+
+
+@pytest.fixture
+def workbook_path(tmp_path):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "BSEG"
+    for row in ROWS:
+        ws.append(row)
+    path = tmp_path / "blocks.xlsx"
+    wb.save(path)
+    return path
+
+
+@pytest.mark.parametrize("block_rows", [2, 4, 10000])
+@pytest.mark.parametrize("path", INTEGRATORS, ids=lambda p: p.stem)
+def test_blocks_share_whole_sheet_dtypes(path, workbook_path, block_rows):
+    _, blocks = streamed_blocks(load_integrator(path), workbook_path, block_rows)
+
+    assert sum(len(df) for df in blocks) == len(ROWS) - 1
+    assert all((df.dtypes == blocks[0].dtypes).all() for df in blocks)
+
+
+@pytest.mark.parametrize("block_rows", [2, 4, 10000])
+@pytest.mark.parametrize("path", INTEGRATORS, ids=lambda p: p.stem)
+def test_blocks_store_like_whole_sheet_read_excel(path, workbook_path, block_rows):
+    sql_types, blocks = streamed_blocks(load_integrator(path), workbook_path, block_rows)
+
+    conn = sqlite3.connect(":memory:")
+    streamed = write_table(conn, "streamed", blocks, dtype=sql_types)
+    whole = write_table(conn, "whole", [pd.read_excel(workbook_path, sheet_name="BSEG")])
+
+    assert streamed == whole
+    assert streamed[0] == ["TEXT", "TEXT", "TEXT"]
+    assert [row[0] for row in streamed[1]] == ["100005062", "100005063", None, "400", "DOC-5", "6"]
+    # Text late in a numeric column keeps the whole column TEXT, so the > 50000 filter sees the same rows
+    query = "SELECT COUNT(*) FROM {} WHERE WRBTR > 50000"
+    assert conn.execute(query.format("streamed")).fetchone() == conn.execute(query.format("whole")).fetchone()
+
+
+@pytest.mark.parametrize("path", INTEGRATORS, ids=lambda p: p.stem)
+def test_header_only_sheet_yields_one_empty_block(path, tmp_path):
+    integrator = load_integrator(path)
+    wb = openpyxl.Workbook()
+    wb.active.append(["BELNR", "WRBTR"])
+    wb.save(tmp_path / "empty.xlsx")
+    with pd.ExcelFile(tmp_path / "empty.xlsx", engine='calamine') as workbook:
+        blocks = list(integrator.sheet_blocks(workbook.parse(wb.active.title)))
+
+    assert [list(df.columns) for df in blocks] == [["BELNR", "WRBTR"]]
+    assert len(blocks[0]) == 0
+
+
+@pytest.mark.parametrize("path", INTEGRATORS, ids=lambda p: p.stem)
+def test_sheet_wider_than_sqlite_allows_fails_before_parsing(path, workbook_path):
+    integrator = load_integrator(path)
+    with pd.ExcelFile(workbook_path, engine='calamine') as workbook:
+        with pytest.raises(ValueError, match="too many columns on P2P_BSEG"):
+            integrator.read_sheet(workbook, "BSEG", "P2P_BSEG", max_columns=2)
+        assert list(integrator.read_sheet(workbook, "BSEG", "P2P_BSEG", max_columns=3).columns) == ROWS[0]